@@ -0,0 +1,407 @@
+import os
+import asyncio
+import logging
+import time
+from datetime import datetime
+from functools import wraps
+from aiohttp import web
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from io import BytesIO
+
+from main import (
+    API_TOKEN, STYLES, QUESTIONS, TOTAL_STEPS, GUIDES, LEAD_CONFIG, SPECIALIST_CHATS, REGIONS,
+    OVERLOAD_CONFIG, OVERLOAD_NOTICE, FLOOD_NOTICE,
+    CostCalculator, BillOfMaterials, LeadQueue, LoadMonitor, flood_guard,
+    get_user_data, create_project, advance_questionnaire, question_text, question_keyboard,
+    store_answer, track_event, create_main_menu, format_result, latest_completed_project,
+    render_pdf, format_lead, admin_authorized, export_stream
+)
+
+logger = logging.getLogger(__name__)
+
+# Все запросы к Telegram и self-ping идут через одну aiohttp-сессию telebot
+asyncio_helper.REQUEST_LIMIT = int(os.getenv('ASYNC_REQUEST_LIMIT', 500))
+
+bot = AsyncTeleBot(API_TOKEN)
+scheduler = AsyncIOScheduler()
+
+# Чаты, от которых ждем ответ на вопрос анкеты: chat_id -> номер шага
+awaiting_answers = {}
+pending_updates = set()
+
+# Бэклог асинхронной версии — апдейты, задачи которых еще не завершились
+load_monitor = LoadMonitor(
+    lambda: len(pending_updates),
+    OVERLOAD_CONFIG['max_backlog'],
+    OVERLOAD_CONFIG['max_latency'],
+    OVERLOAD_CONFIG['reject_backlog'],
+    OVERLOAD_CONFIG['latency_smoothing'],
+    OVERLOAD_CONFIG['latency_decay']
+)
+
+def load_guard(action=None):
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(message, *args, **kwargs):
+            load_monitor.observe(message)
+            if action and load_monitor.overloaded():
+                load_monitor.record_shed(action)
+                await bot.send_message(message.chat.id, OVERLOAD_NOTICE)
+                return
+            return await handler(message, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class AsyncLeadQueue(LeadQueue):
+    def start(self):
+        self.queue = asyncio.Queue()
+        return asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                try:
+                    self._hold(*await asyncio.wait_for(self.queue.get(), self._timeout()))
+                    self.queue.task_done()
+                except asyncio.TimeoutError:
+                    pass
+                for chat_id, text in self._ready():
+                    try:
+                        await bot.send_message(chat_id, text)
+                    except Exception as e:
+                        logger.error(f"Ошибка доставки заявки: {str(e)}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Ошибка очереди заявок: {str(e)}")
+                await asyncio.sleep(1)
+
+lead_queue = AsyncLeadQueue(
+    SPECIALIST_CHATS,
+    LEAD_CONFIG['rate_limit'],
+    LEAD_CONFIG['rate_period'],
+    LEAD_CONFIG['max_message_length'],
+    REGIONS
+)
+
+def schedule_reminder(user_id, project_name):
+    job_id = f"reminder_{user_id}_{project_name}"
+    if not scheduler.get_job(job_id):
+        scheduler.add_job(
+            send_reminder,
+            'interval',
+            days=1,
+            id=job_id,
+            args=[user_id, project_name],
+            max_instances=3
+        )
+
+async def send_reminder(user_id, project_name):
+    try:
+        await bot.send_message(
+            user_id,
+            f"{STYLES['warning']} Напоминание о проекте '{project_name}'\n"
+            f"Продолжить расчет? Используйте /menu"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка напоминания: {str(e)}")
+
+# Ответы на анкету проверяются первыми — как next_step_handler в синхронной версии
+@bot.message_handler(func=lambda m: m.chat.id in awaiting_answers)
+@load_guard()
+async def process_answer(message):
+    user_id = message.chat.id
+    current_step = awaiting_answers.pop(user_id)
+    user = get_user_data(user_id)
+    project = user['projects'][user['current_project']]
+
+    if message.text == "🔙 Назад":
+        if current_step > 0:
+            project['data']['step'] = current_step - 1
+            return await ask_next_question(user_id)
+        else:
+            return await show_main_menu(message)
+    if message.text == "❌ Отменить расчет":
+        del user['projects'][user['current_project']]
+        user['current_project'] = None
+        return await show_main_menu(message)
+
+    question = QUESTIONS[current_step]
+    try:
+        store_answer(project, question, (message.text or '').strip())
+        project['data']['step'] = current_step + 1
+        user['last_active'] = datetime.now()
+    except Exception as e:
+        logger.error(f"Ошибка пользователя {user_id}: {str(e)}")
+        await bot.send_message(
+            user_id,
+            f"{STYLES['error']} Ошибка:\n{str(e)}\nПовторите ввод:",
+            reply_markup=question_keyboard(user_id, question)
+        )
+        awaiting_answers[user_id] = current_step
+        track_event('abandon', current_step)
+        return
+
+    await ask_next_question(user_id)
+
+@bot.message_handler(commands=['start', 'menu'])
+@load_guard()
+async def show_main_menu(message):
+    user_id = message.chat.id
+    user = get_user_data(user_id)
+    user['last_active'] = datetime.now()
+    await bot.send_message(user_id, f"{STYLES['header']} Главное меню:", reply_markup=create_main_menu())
+
+@bot.message_handler(func=lambda m: m.text == "🏠 Новый проект")
+@load_guard()
+async def start_new_project(message):
+    user_id = message.chat.id
+    create_project(get_user_data(user_id))
+    track_event('start')
+    await ask_next_question(user_id)
+
+async def ask_next_question(user_id):
+    user = get_user_data(user_id)
+    project = user['projects'][user['current_project']]
+    current_step = advance_questionnaire(project)
+
+    if current_step >= TOTAL_STEPS:
+        await calculate_and_send_result(user_id)
+        return
+
+    markup = question_keyboard(user_id, QUESTIONS[current_step])
+    await bot.send_message(user_id, question_text(current_step), reply_markup=markup)
+    awaiting_answers[user_id] = current_step
+
+async def calculate_and_send_result(user_id):
+    user = get_user_data(user_id)
+    project = user['projects'][user['current_project']]
+    try:
+        total, details = CostCalculator.calculate_total(project['data'])
+        text, markup = format_result(total, details)
+        await bot.send_message(user_id, text, reply_markup=markup, parse_mode='HTML')
+        schedule_reminder(user_id, project['name'])
+        project['completed'] = True
+    except Exception as e:
+        logger.error(f"Ошибка расчета: {str(e)}")
+        await bot.send_message(user_id, f"{STYLES['error']} Ошибка расчета: {str(e)}")
+        track_event('abandon', project['data'].get('step', 0))
+
+@bot.message_handler(func=lambda m: m.text == "🖨️ Экспорт в PDF")
+@load_guard('pdf_export')
+async def export_to_pdf(message):
+    user_id = message.chat.id
+    project = latest_completed_project(get_user_data(user_id))
+    if not project:
+        await bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
+        return
+
+    try:
+        total, details = CostCalculator.calculate_total(project['data'])
+        # ReportLab синхронный — рендерим в пуле потоков, чтобы не блокировать цикл событий
+        buffer = await asyncio.to_thread(render_pdf, project, total, details)
+        await bot.send_document(
+            user_id,
+            ('smeta.pdf', buffer),
+            caption=f"🖨️ Смета проекта {project['name']}",
+            reply_markup=create_main_menu()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка генерации PDF: {str(e)}")
+        await bot.send_message(user_id, f"{STYLES['error']} Ошибка генерации PDF: {str(e)}")
+
+@bot.message_handler(func=lambda m: m.text == "📋 Ведомость материалов")
+@load_guard()
+async def export_bom(message):
+    user_id = message.chat.id
+    project = latest_completed_project(get_user_data(user_id))
+    if not project:
+        await bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
+        return
+
+    try:
+        bom = BillOfMaterials.calculate(project['data'])
+        await bot.send_document(
+            user_id,
+            ('vedomost.csv', BytesIO(BillOfMaterials.to_csv(bom))),
+            caption=f"📋 Ведомость материалов проекта {project['name']}",
+            reply_markup=create_main_menu()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки ведомости: {str(e)}")
+        await bot.send_message(user_id, f"{STYLES['error']} Ошибка выгрузки ведомости: {str(e)}")
+
+@bot.message_handler(func=lambda m: m.text == "📨 Отправить специалисту")
+@load_guard('specialist_send')
+async def send_to_specialist(message):
+    user_id = message.chat.id
+    project = latest_completed_project(get_user_data(user_id))
+    if not project:
+        await bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
+        return
+
+    try:
+        total, details = CostCalculator.calculate_total(project['data'])
+        lead_queue.submit(
+            project['data'].get('region', 'Другой'),
+            format_lead(project, message.from_user.username, total, details),
+            low_priority=total < LEAD_CONFIG['low_priority_total']
+        )
+        await bot.send_message(user_id, f"{STYLES['success']} Запрос принят, специалист свяжется с вами!")
+    except Exception as e:
+        logger.error(f"Ошибка отправки: {str(e)}")
+        await bot.send_message(user_id, f"{STYLES['error']} Ошибка отправки: {str(e)}")
+
+    await show_main_menu(message)
+
+@bot.message_handler(func=lambda m: m.text == "📚 Гайды")
+@load_guard()
+async def show_guides_menu(message):
+    user_id = message.chat.id
+    user = get_user_data(user_id)
+    user['last_active'] = datetime.now()
+
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add(*[g['title'] for g in GUIDES.values()])
+    markup.add("🔙 Главное меню")
+
+    await bot.send_message(
+        user_id,
+        f"{STYLES['header']} Выберите раздел гайда:",
+        reply_markup=markup
+    )
+
+@bot.message_handler(func=lambda m: m.text in [g['title'] for g in GUIDES.values()])
+@load_guard()
+async def show_guide_content(message):
+    user_id = message.chat.id
+    user = get_user_data(user_id)
+    user['last_active'] = datetime.now()
+
+    for guide in GUIDES.values():
+        if guide['title'] == message.text:
+            markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+            markup.add("🔙 К списку гайдов")
+
+            await bot.send_message(
+                user_id,
+                f"📖 <b>{guide['title']}</b>\n{guide['content']}",
+                parse_mode='HTML',
+                reply_markup=markup
+            )
+            break
+
+@bot.message_handler(func=lambda m: m.text == "🔙 К списку гайдов")
+@load_guard()
+async def back_to_guides(message):
+    await show_guides_menu(message)
+
+@bot.message_handler(func=lambda m: m.text == "🔙 Главное меню")
+@load_guard()
+async def back_to_main_menu(message):
+    user = get_user_data(message.chat.id)
+    user['current_project'] = None
+    await show_main_menu(message)
+
+async def index(request):
+    return web.Response(text="Telegram-бот работает!")
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    pending_updates.add(task)
+    task.add_done_callback(pending_updates.discard)
+
+async def webhook(request):
+    if load_monitor.backlog() >= load_monitor.reject_backlog:
+        # Telegram повторит доставку позже
+        load_monitor.record_shed('update')
+        return web.Response(status=503)
+    update = types.Update.de_json(await request.text())
+    if update.message:
+        update.message.received_at = time.monotonic()
+        allowed, notify = flood_guard.check(update.message)
+        if notify:
+            spawn(bot.send_message(update.message.chat.id, FLOOD_NOTICE))
+        if not allowed:
+            return web.Response()
+    # Отвечаем Telegram сразу, обработка идет в отдельной задаче
+    spawn(bot.process_new_updates([update]))
+    return web.Response()
+
+async def admin_export(request):
+    if not admin_authorized(request.headers.get('X-Admin-Token')):
+        return web.Response(status=403)
+    export = export_stream(request.query.get('dataset', 'projects'), request.query.get('format', 'csv'))
+    if export is None:
+        return web.Response(status=400)
+    chunks, mimetype, filename = export
+
+    response = web.StreamResponse(headers={
+        'Content-Type': mimetype,
+        'Content-Disposition': f'attachment; filename={filename}'
+    })
+    await response.prepare(request)
+    # Фрагменты собираются в пуле потоков, цикл событий продолжает обрабатывать апдейты
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await response.write(chunk.encode('utf-8'))
+    await response.write_eof()
+    return response
+
+async def load_stats(request):
+    if not admin_authorized(request.headers.get('X-Admin-Token')):
+        return web.Response(status=403)
+    return web.json_response(dict(load_monitor.stats(), flood_dropped=flood_guard.dropped))
+
+async def self_ping():
+    while True:
+        try:
+            session = await asyncio_helper.session_manager.get_session()
+            async with session.get("https://karkasmaster.onrender.com") as response:
+                await response.read()
+            logger.info("Self-ping успешен")
+        except Exception as e:
+            logger.error(f"Ошибка self-ping: {str(e)}")
+        await asyncio.sleep(300)
+
+async def flush_digests():
+    # Корутина выполняется в цикле событий; синхронную задачу APScheduler
+    # запустил бы в пуле потоков, а asyncio.Queue не потокобезопасна
+    lead_queue.flush_digests()
+
+async def on_startup(app):
+    scheduler.start()
+    scheduler.add_job(
+        flush_digests,
+        'interval',
+        minutes=LEAD_CONFIG['digest_interval'],
+        id='lead_digest'
+    )
+    app['background'] = [lead_queue.start(), asyncio.create_task(self_ping())]
+
+    await bot.remove_webhook()
+    await bot.set_webhook(url=f"https://karkasmaster.onrender.com/{API_TOKEN}")
+
+async def on_cleanup(app):
+    for task in app['background']:
+        task.cancel()
+    scheduler.shutdown(wait=False)
+    await bot.close_session()
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', index)
+    app.router.add_post(f'/{API_TOKEN}', webhook)
+    app.router.add_get('/admin/export', admin_export)
+    app.router.add_get('/load', load_stats)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == '__main__':
+    port = int(os.getenv('PORT', 5000))
+    web.run_app(create_app(), host='0.0.0.0', port=port)
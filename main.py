@@ -1,15 +1,24 @@
 import requests
 import os
+import json
 import logging
 import math
+import csv
+import hmac
+import queue
+import threading
+import time
+from collections import deque, OrderedDict
 from datetime import datetime
-from flask import Flask, request, send_file
+from functools import wraps, lru_cache
+from itertools import islice
+from flask import Flask, Response, request, send_file, jsonify
 import telebot
 from telebot import types
 from apscheduler.schedulers.background import BackgroundScheduler
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-from io import BytesIO
+from io import BytesIO, StringIO
 
 logging.basicConfig(
     level=logging.INFO,
@@ -24,10 +33,12 @@ def index():
     return "Telegram-бот работает!"
 
 API_TOKEN = os.getenv('API_TOKEN')
-bot = telebot.TeleBot(API_TOKEN)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Пул потоков и планировщик запускаются в start_background(), чтобы импорт модуля
+# (например, из async_main) не поднимал фоновые потоки синхронного бота
+bot = telebot.TeleBot(API_TOKEN, threaded=False)
 
 scheduler = BackgroundScheduler()
-scheduler.start()
 
 user_data = {}
 analytics_data = {
@@ -118,16 +129,126 @@ COST_CONFIG = {
     }
 }
 
+# Коэффициенты по регионам: 'default' — для всего, ключ категории материалов
+# ('foundation', 'roof', ...), 'work' — для всех работ, либо конкретный вид работ ('carpentry', ...)
 REGIONAL_COEFFICIENTS = {
-    'Калужская обл': 1.0,
-    'Московская обл': 1.2,
-    'Другой': 1.5
+    'Калужская обл': {'default': 1.0},
+    'Московская обл': {'default': 1.2},
+    'Другой': {'default': 1.5}
+}
+
+def check_regional_coefficients(coefficients, source):
+    allowed = {'default', 'work'} | set(COST_CONFIG['materials']) | set(COST_CONFIG['work'])
+    for region, coeffs in coefficients.items():
+        if not isinstance(coeffs, dict):
+            raise ValueError(
+                f"{source}: для региона {region!r} ожидается объект коэффициентов, "
+                f"например {{\"default\": {coeffs}}}"
+            )
+        for key, value in coeffs.items():
+            if key not in allowed:
+                raise ValueError(
+                    f"{source}: неизвестная категория {key!r} у региона {region!r}; "
+                    f"допустимы: {', '.join(sorted(allowed))}"
+                )
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"{source}: коэффициент {region!r}/{key!r} должен быть положительным числом")
+
+if os.getenv('REGIONAL_PRICING_FILE'):
+    with open(os.getenv('REGIONAL_PRICING_FILE'), encoding='utf-8') as f:
+        regional_file = json.load(f)
+    if not isinstance(regional_file, dict):
+        raise ValueError("REGIONAL_PRICING_FILE: ожидается объект {регион: {категория: коэффициент}}")
+    check_regional_coefficients(regional_file, 'REGIONAL_PRICING_FILE')
+    REGIONAL_COEFFICIENTS.update(regional_file)
+
+def scale_prices(node, coeff):
+    if not isinstance(node, dict):
+        return node
+    return {
+        key: value * coeff if key.startswith('price') else scale_prices(value, coeff)
+        for key, value in node.items()
+    }
+
+def compile_price_tables(config, regional_coefficients):
+    tables = {}
+    for region, coeffs in regional_coefficients.items():
+        default = coeffs.get('default', 1.0)
+        tables[region] = {
+            'materials': {
+                category: scale_prices(items, coeffs.get(category, default))
+                for category, items in config['materials'].items()
+            },
+            'work': {
+                kind: scale_prices(item, coeffs.get(kind, coeffs.get('work', default)))
+                for kind, item in config['work'].items()
+            }
+        }
+    return tables
+
+# Готовые прайс-таблицы по регионам — при расчете сметы только выбираем нужную
+PRICE_TABLES = compile_price_tables(COST_CONFIG, REGIONAL_COEFFICIENTS)
+
+# Исходные данные проекта, от которых зависит ведомость материалов
+BOM_INPUTS = (
+    'foundation_type', 'width', 'length', 'height', 'house_style', 'floors', 'roof_type',
+    'wall_insulation_type', 'wall_insulation_thickness', 'exterior_type',
+    'window_count', 'entrance_doors', 'interior_doors'
+)
+
+BOM_SECTIONS = {
+    'foundation': 'Фундамент',
+    'roof': 'Кровля',
+    'walls': 'Каркас',
+    'insulation': 'Утепление',
+    'windows': 'Окна',
+    'doors': 'Двери'
+}
+
+REGIONS = [r for r in REGIONAL_COEFFICIENTS if r != 'Другой'] + ['Другой']
+
+# Пул специалистов по регионам: {"Калужская обл": [id, ...], "*": [id, ...]}
+SPECIALIST_CHATS = json.loads(os.getenv('SPECIALIST_CHATS', '{"*": [515650034]}'))
+
+LEAD_CONFIG = {
+    'rate_limit': int(os.getenv('LEAD_RATE_LIMIT', 20)),
+    'rate_period': int(os.getenv('LEAD_RATE_PERIOD', 60)),
+    'digest_interval': int(os.getenv('LEAD_DIGEST_MINUTES', 30)),
+    'low_priority_total': int(os.getenv('LEAD_LOW_PRIORITY_TOTAL', 0)),
+    'max_message_length': 4000
+}
+
+OVERLOAD_CONFIG = {
+    'max_backlog': int(os.getenv('OVERLOAD_MAX_BACKLOG', 50)),
+    'max_latency': float(os.getenv('OVERLOAD_MAX_LATENCY', 5.0)),
+    'reject_backlog': int(os.getenv('OVERLOAD_REJECT_BACKLOG', 1000)),
+    'latency_smoothing': 0.2,
+    'latency_decay': float(os.getenv('OVERLOAD_LATENCY_DECAY', 30))  # секунд
+}
+
+FLOOD_CONFIG = {
+    'capacity': float(os.getenv('FLOOD_BUCKET_CAPACITY', 10)),
+    'refill_rate': float(os.getenv('FLOOD_REFILL_RATE', 1.0)),  # токенов в секунду
+    'max_chats': int(os.getenv('FLOOD_MAX_CHATS', 10000)),
+    'notice_cooldown': float(os.getenv('FLOOD_NOTICE_COOLDOWN', 60)),  # секунд между предупреждениями
+    'costs': {
+        'default': 1,
+        'bom_export': 2,
+        'specialist_send': 3,
+        'pdf_export': 5
+    }
+}
+
+FLOOD_ACTIONS = {
+    "🖨️ Экспорт в PDF": 'pdf_export',
+    "📨 Отправить специалисту": 'specialist_send',
+    "📋 Ведомость материалов": 'bom_export'
 }
 
 QUESTIONS = [
     {
         'text': '📍 Регион строительства:',
-        'options': ['Калужская обл', 'Московская обл', 'Другой'],
+        'options': REGIONS,
         'key': 'region',
         'row_width': 2
     },
@@ -336,6 +457,129 @@ def track_event(event_type, step=None):
     elif event_type == 'abandon':
         analytics_data['abandoned_steps'][step] = analytics_data['abandoned_steps'].get(step, 0) + 1
 
+class LoadMonitor:
+    def __init__(self, backlog, max_backlog, max_latency, reject_backlog, smoothing, decay):
+        # backlog — функция, возвращающая число необработанных апдейтов
+        self.backlog = backlog
+        self.max_backlog = max_backlog
+        self.max_latency = max_latency
+        self.reject_backlog = reject_backlog
+        self.smoothing = smoothing
+        self.decay = decay
+        self.latency = 0.0
+        self.observed_at = time.monotonic()
+        self.shed = {}
+        self.lock = threading.Lock()
+
+    def observe(self, message):
+        # Задержка между приходом апдейта в вебхук и началом обработки;
+        # message.date не подходит — Telegram повторно доставляет старые апдейты
+        received_at = getattr(message, 'received_at', None)
+        if received_at is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            latency = self._decayed(now)
+            self.latency = latency + self.smoothing * (now - received_at - latency)
+            self.observed_at = now
+
+    def _decayed(self, now):
+        # Без новых замеров оценка затухает, простой не держит бота «перегруженным»
+        return self.latency * math.exp(-(now - self.observed_at) / self.decay)
+
+    def current_latency(self):
+        return self._decayed(time.monotonic())
+
+    def overloaded(self):
+        return self.backlog() >= self.max_backlog or self.current_latency() >= self.max_latency
+
+    def record_shed(self, action):
+        with self.lock:
+            self.shed[action] = self.shed.get(action, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backlog': self.backlog(),
+                'latency': round(self.current_latency(), 2),
+                'overloaded': self.overloaded(),
+                'shed': dict(self.shed)
+            }
+
+def telebot_backlog():
+    # Очередь задач пула потоков telebot (при threaded=True)
+    tasks = getattr(getattr(bot, 'worker_pool', None), 'tasks', None)
+    return tasks.qsize() if tasks is not None else 0
+
+load_monitor = LoadMonitor(
+    telebot_backlog,
+    OVERLOAD_CONFIG['max_backlog'],
+    OVERLOAD_CONFIG['max_latency'],
+    OVERLOAD_CONFIG['reject_backlog'],
+    OVERLOAD_CONFIG['latency_smoothing'],
+    OVERLOAD_CONFIG['latency_decay']
+)
+
+class FloodGuard:
+    def __init__(self, capacity, refill_rate, max_chats, costs, notice_cooldown):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.max_chats = max_chats
+        self.costs = costs
+        self.notice_cooldown = notice_cooldown
+        # chat_id -> (токены, время обновления, время последнего предупреждения); старые чаты вытесняются
+        self.buckets = OrderedDict()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def consume(self, chat_id, action=None):
+        # Возвращает (пропустить сообщение, отправить ли предупреждение)
+        cost = self.costs.get(action, self.costs['default'])
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at, noticed_at = self.buckets.pop(chat_id, (self.capacity, now, None))
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.refill_rate)
+            if tokens >= cost:
+                self.buckets[chat_id] = (tokens - cost, now, noticed_at)
+                allowed, notify = True, False
+            else:
+                self.dropped += 1
+                notify = noticed_at is None or now - noticed_at >= self.notice_cooldown
+                self.buckets[chat_id] = (tokens, now, now if notify else noticed_at)
+                allowed = False
+            if len(self.buckets) > self.max_chats:
+                self.buckets.popitem(last=False)
+        return allowed, notify
+
+    def check(self, message):
+        return self.consume(message.chat.id, FLOOD_ACTIONS.get(message.text))
+
+flood_guard = FloodGuard(
+    FLOOD_CONFIG['capacity'],
+    FLOOD_CONFIG['refill_rate'],
+    FLOOD_CONFIG['max_chats'],
+    FLOOD_CONFIG['costs'],
+    FLOOD_CONFIG['notice_cooldown']
+)
+
+FLOOD_NOTICE = f"{STYLES['warning']} Слишком много запросов, подождите несколько секунд"
+
+OVERLOAD_NOTICE = f"{STYLES['warning']} Сервис перегружен, повторите попытку через минуту"
+
+def load_guard(action=None):
+    # action задаётся только для тяжёлых операций — их откладываем при перегрузке
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(message, *args, **kwargs):
+            load_monitor.observe(message)
+            if action and load_monitor.overloaded():
+                load_monitor.record_shed(action)
+                bot.send_message(message.chat.id, OVERLOAD_NOTICE)
+                return
+            return handler(message, *args, **kwargs)
+        return wrapper
+    return decorator
+
 def create_main_menu():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     buttons = ["🏠 Новый проект", "📚 Гайды"]
@@ -343,6 +587,7 @@ def create_main_menu():
     return markup
 
 @bot.message_handler(commands=['start', 'menu'])
+@load_guard()
 def show_main_menu(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
@@ -350,9 +595,14 @@ def show_main_menu(message):
     bot.send_message(user_id, f"{STYLES['header']} Главное меню:", reply_markup=create_main_menu())
 
 @bot.message_handler(func=lambda m: m.text == "🏠 Новый проект")
+@load_guard()
 def start_new_project(message):
     user_id = message.chat.id
-    user = get_user_data(user_id)
+    create_project(get_user_data(user_id))
+    track_event('start')
+    ask_next_question(user_id)
+
+def create_project(user):
     project_id = f"project_{datetime.now().strftime('%Y%m%d%H%M%S')}"
     user['projects'][project_id] = {
         'name': f"Проект от {datetime.now().strftime('%d.%m.%Y')}",
@@ -369,12 +619,9 @@ def start_new_project(message):
         'completed': False
     }
     user['current_project'] = project_id
-    track_event('start')
-    ask_next_question(user_id)
+    return user['projects'][project_id]
 
-def ask_next_question(user_id):
-    user = get_user_data(user_id)
-    project = user['projects'][user['current_project']]
+def advance_questionnaire(project):
     current_step = project['data'].get('step', 0)
     
     if project['data'].get('house_style') in ['A-frame', 'BARNHOUSE', 'ХОЗБЛОК']:
@@ -390,24 +637,34 @@ def ask_next_question(user_id):
             project['data']['step'] = current_step
         else:
             break
-    
-    if current_step >= TOTAL_STEPS:
-        calculate_and_send_result(user_id)
-        return
-    
-    question = QUESTIONS[current_step]
-    progress_text = (
+    return current_step
+
+def question_text(current_step):
+    return (
         f"{STYLES['header']} Шаг {current_step + 1}/{TOTAL_STEPS}\n"
-        f"{question['text']}"
+        f"{QUESTIONS[current_step]['text']}"
     )
-    markup = create_keyboard(
+
+def question_keyboard(user_id, question):
+    return create_keyboard(
         user_id,
         question['options'],
         question.get('row_width', 2),
         'Пропустить' in question.get('options', []),
         back_button=True
     )
-    bot.send_message(user_id, progress_text, reply_markup=markup)
+
+def ask_next_question(user_id):
+    user = get_user_data(user_id)
+    project = user['projects'][user['current_project']]
+    current_step = advance_questionnaire(project)
+    
+    if current_step >= TOTAL_STEPS:
+        calculate_and_send_result(user_id)
+        return
+    
+    markup = question_keyboard(user_id, QUESTIONS[current_step])
+    bot.send_message(user_id, question_text(current_step), reply_markup=markup)
     bot.register_next_step_handler_by_chat_id(user_id, process_answer, current_step=current_step)
 
 def validate_input(answer, question, user_data):
@@ -431,6 +688,23 @@ def validate_input(answer, question, user_data):
             return "Количество не может быть отрицательным"
     return None
 
+def store_answer(project, question, answer):
+    error = validate_input(answer, question, project['data'])
+    if error:
+        raise ValueError(error)
+    if answer == 'Пропустить':
+        project['data'][question['key']] = None
+    else:
+        if question['key'] in ['window_count', 'entrance_doors', 'interior_doors']:
+            project['data'][question['key']] = int(answer)
+        elif question['key'] in ['width', 'length', 'height']:
+            project['data'][question['key']] = float(answer.replace(',', '.'))
+        elif question['key'] == 'wall_insulation_thickness':
+            project['data'][question['key']] = int(answer)
+        else:
+            project['data'][question['key']] = answer
+
+@load_guard()
 def process_answer(message, current_step):
     user_id = message.chat.id
     user = get_user_data(user_id)
@@ -449,21 +723,7 @@ def process_answer(message, current_step):
     
     question = QUESTIONS[current_step]
     try:
-        answer = message.text.strip()
-        error = validate_input(answer, question, project['data'])
-        if error:
-            raise ValueError(error)
-        if answer == 'Пропустить':
-            project['data'][question['key']] = None
-        else:
-            if question['key'] in ['window_count', 'entrance_doors', 'interior_doors']:
-                project['data'][question['key']] = int(answer)
-            elif question['key'] in ['width', 'length', 'height']:
-                project['data'][question['key']] = float(answer.replace(',', '.'))
-            elif question['key'] == 'wall_insulation_thickness':
-                project['data'][question['key']] = int(answer)
-            else:
-                project['data'][question['key']] = answer
+        store_answer(project, question, message.text.strip())
         project['data']['step'] = current_step + 1
         user['last_active'] = datetime.now()
     except Exception as e:
@@ -471,13 +731,7 @@ def process_answer(message, current_step):
         bot.send_message(
             user_id,
             f"{STYLES['error']} Ошибка:\n{str(e)}\nПовторите ввод:",
-            reply_markup=create_keyboard(
-                user_id,
-                question['options'],
-                question.get('row_width', 2),
-                'Пропустить' in question.get('options', []),
-                back_button=True
-            )
+            reply_markup=question_keyboard(user_id, question)
         )
         bot.register_next_step_handler_by_chat_id(user_id, process_answer, current_step=current_step)
         track_event('abandon', current_step)
@@ -487,108 +741,125 @@ def process_answer(message, current_step):
 
 class DimensionCalculator:
     @staticmethod
-    def calculate_foundation(data):
-        foundation_type = data['foundation_type']
-        perimeter = 2 * (data['width'] + data['length'])
-        config = COST_CONFIG['materials']['foundation'][foundation_type]
-        
-        if foundation_type == 'Свайно-винтовой':
-            piles_count = math.ceil(perimeter / 1.5)
-            return piles_count * config['price_per_pile']
-        elif foundation_type == 'Ленточный':
-            depth = 0.8
-            width = 0.4
-            volume = perimeter * depth * width
-            return volume * config['price_per_m3']
-        elif foundation_type == 'Плитный':
-            area = data['width'] * data['length']
-            return area * config['price_per_m2']
-        return 0
+    def perimeter(data):
+        return 2 * (data['width'] + data['length'])
+
+    @staticmethod
+    def wall_area(data):
+        return DimensionCalculator.perimeter(data) * data.get('height', 2.5)
 
     @staticmethod
-    def calculate_roof(data):
+    def roof_area(data):
         style = data.get('house_style')
         roof_type = data.get('roof_type', 'Фальцевая кровля')
-        config = COST_CONFIG['materials']['roof'][roof_type]
-        width = data['width']
-        length = data['length']
+        slope_factor = COST_CONFIG['materials']['roof'][roof_type]['slope_factor']
         
         if style == 'Скандинавский стиль':
             slope = 25 if data['floors'] == 'Одноэтажный' else 35
         else:
             slope = 45
         
-        roof_length = (width / 2) / math.cos(math.radians(slope))
-        roof_area = 2 * roof_length * length * config['slope_factor']
-        material_cost = roof_area * config['price_per_m2']
-        work_cost = roof_area * COST_CONFIG['work']['roof_installation']['price_per_m2']
-        return material_cost + work_cost
+        roof_length = (data['width'] / 2) / math.cos(math.radians(slope))
+        return 2 * roof_length * data['length'] * slope_factor
 
     @staticmethod
-    def calculate_walls(data):
-        perimeter = 2 * (data['width'] + data['length'])
-        height = data.get('height', 2.5)
-        wall_area = perimeter * height
+    def insulation_volume(data):
+        insulation_config = COST_CONFIG['materials']['wall_insulation'][data['wall_insulation_type']]
+        thickness = data.get('wall_insulation_thickness', insulation_config['min_thickness']) / 1000
+        return DimensionCalculator.wall_area(data) * thickness
+
+class BillOfMaterials:
+    # Строка ведомости: (раздел, наименование, ед. изм., количество, путь к цене в прайс-таблице)
+    @staticmethod
+    def calculate(data, cached=True):
+        inputs = tuple((key, data[key]) for key in BOM_INPUTS if key in data)
+        if not cached:
+            # Разовые массовые расчеты (выгрузка) не вытесняют из кэша активные чаты
+            return BillOfMaterials._calculate.__wrapped__(inputs)
+        return BillOfMaterials._calculate(inputs)
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _calculate(inputs):
+        data = dict(inputs)
+        lines = []
+        
+        foundation_type = data['foundation_type']
+        perimeter = DimensionCalculator.perimeter(data)
+        if foundation_type == 'Свайно-винтовой':
+            lines.append(('foundation', 'Сваи винтовые', 'шт', math.ceil(perimeter / 1.5),
+                          ('materials', 'foundation', foundation_type, 'price_per_pile')))
+        elif foundation_type == 'Ленточный':
+            lines.append(('foundation', 'Бетон ленточного фундамента', 'м³', perimeter * 0.8 * 0.4,
+                          ('materials', 'foundation', foundation_type, 'price_per_m3')))
+        elif foundation_type == 'Плитный':
+            lines.append(('foundation', 'Фундаментная плита', 'м²', data['width'] * data['length'],
+                          ('materials', 'foundation', foundation_type, 'price_per_m2')))
         
-        frame_config = COST_CONFIG['materials']['wall_frame']['Каркас 50x150']
-        frame_volume = wall_area * 0.15  # 150 мм толщина
-        frame_cost = frame_volume * frame_config['price_per_m3']
+        roof_type = data.get('roof_type', 'Фальцевая кровля')
+        roof_area = DimensionCalculator.roof_area(data)
+        lines.append(('roof', f"Кровля ({roof_type})", 'м²', roof_area,
+                      ('materials', 'roof', roof_type, 'price_per_m2')))
+        lines.append(('roof', 'Монтаж кровли', 'м²', roof_area,
+                      ('work', 'roof_installation', 'price_per_m2')))
         
-        insulation_type = data['wall_insulation_type']
-        insulation_config = COST_CONFIG['materials']['wall_insulation'][insulation_type]
-        insulation_thickness = data.get('wall_insulation_thickness', insulation_config['min_thickness']) / 1000
-        insulation_volume = wall_area * insulation_thickness
-        insulation_cost = insulation_volume * insulation_config['price_per_m3']
+        wall_area = DimensionCalculator.wall_area(data)
+        insulation_volume = DimensionCalculator.insulation_volume(data)
+        lines.append(('walls', 'Пиломатериал 50x150', 'м³', wall_area * 0.15,  # 150 мм толщина
+                      ('materials', 'wall_frame', 'Каркас 50x150', 'price_per_m3')))
+        lines.append(('walls', f"Утеплитель ({data['wall_insulation_type']})", 'м³', insulation_volume,
+                      ('materials', 'wall_insulation', data['wall_insulation_type'], 'price_per_m3')))
+        lines.append(('walls', f"Обшивка ({data['exterior_type']})", 'м²', wall_area,
+                      ('materials', 'wall_cladding', data['exterior_type'], 'price_per_m2')))
+        lines.append(('walls', 'Монтаж каркаса', 'м²', wall_area,
+                      ('work', 'carpentry', 'price_per_m2')))
         
-        cladding_config = COST_CONFIG['materials']['wall_cladding'][data['exterior_type']]
-        cladding_cost = wall_area * cladding_config['price_per_m2']
+        lines.append(('insulation', 'Монтаж утеплителя', 'м³', insulation_volume,
+                      ('work', 'insulation_work', 'price_per_m3')))
         
-        work_cost = wall_area * COST_CONFIG['work']['carpentry']['price_per_m2']
-        return frame_cost + insulation_cost + cladding_cost + work_cost
-
-    @staticmethod
-    def calculate_windows(data):
-        count = data.get('window_count', 1)
-        return count * COST_CONFIG['materials']['windows']['price_per_unit']
+        lines.append(('windows', 'Окна', 'шт', data.get('window_count', 1),
+                      ('materials', 'windows', 'price_per_unit')))
+        
+        lines.append(('doors', 'Входные двери', 'шт', data['entrance_doors'],
+                      ('materials', 'doors', 'входная', 'price')))
+        lines.append(('doors', 'Межкомнатные двери', 'шт', data['interior_doors'],
+                      ('materials', 'doors', 'межкомнатная', 'price')))
+        return tuple(lines)
 
     @staticmethod
-    def calculate_doors(data):
-        entrance = data['entrance_doors']
-        interior = data['interior_doors']
-        return (entrance * COST_CONFIG['materials']['doors']['входная']['price']) + (interior * COST_CONFIG['materials']['doors']['межкомнатная']['price'])
+    def to_csv(bom):
+        buffer = StringIO()
+        writer = csv.writer(buffer, delimiter=';')
+        writer.writerow(['Раздел', 'Наименование', 'Ед.', 'Количество'])
+        for section, name, unit, quantity, _ in bom:
+            writer.writerow([BOM_SECTIONS[section], name, unit, round(quantity, 3)])
+        return buffer.getvalue().encode('utf-8-sig')
 
+class CostCalculator:
     @staticmethod
-    def calculate_insulation_work(data):
-        insulation_volume = 2 * (data['width'] + data['length']) * data.get('height', 2.5) * (data['wall_insulation_thickness'] / 1000)
-        return insulation_volume * COST_CONFIG['work']['insulation_work']['price_per_m3']
+    def price_bom(bom, prices):
+        sections = {}
+        for section, _, _, quantity, path in bom:
+            price = prices
+            for key in path:
+                price = price[key]
+            sections[section] = sections.get(section, 0) + quantity * price
+        return sections
 
-class CostCalculator:
     @staticmethod
-    def calculate_total(data):
-        total = 0
+    def calculate_total(data, cached=True):
         details = []
         
-        foundation = DimensionCalculator.calculate_foundation(data)
-        details.append(f"{EMOJI_MAP['foundation']} Фундамент: {foundation:,.0f}{STYLES['currency']}")
-        
-        roof = DimensionCalculator.calculate_roof(data)
-        details.append(f"{EMOJI_MAP['roof']} Кровля: {roof:,.0f}{STYLES['currency']}")
-        
-        walls = DimensionCalculator.calculate_walls(data)
-        details.append(f"{EMOJI_MAP['wall_frame']} Каркас: {walls:,.0f}{STYLES['currency']}")
-        
-        insulation = DimensionCalculator.calculate_insulation_work(data)
-        details.append(f"{EMOJI_MAP['insulation']} Утепление: {insulation:,.0f}{STYLES['currency']}")
+        region = data.get('region', 'Другой')
+        prices = PRICE_TABLES.get(region, COST_CONFIG)
+        sections = CostCalculator.price_bom(BillOfMaterials.calculate(data, cached), prices)
         
-        windows = DimensionCalculator.calculate_windows(data)
-        details.append(f"{EMOJI_MAP['windows']} Окна: {windows:,.0f}{STYLES['currency']}")
+        for section, emoji in [('foundation', 'foundation'), ('roof', 'roof'), ('walls', 'wall_frame'),
+                               ('insulation', 'insulation'), ('windows', 'windows'), ('doors', 'doors')]:
+            details.append(f"{EMOJI_MAP[emoji]} {BOM_SECTIONS[section]}: {sections.get(section, 0):,.0f}{STYLES['currency']}")
         
-        doors = DimensionCalculator.calculate_doors(data)
-        details.append(f"{EMOJI_MAP['doors']} Двери: {doors:,.0f}{STYLES['currency']}")
-        
-        region_coeff = REGIONAL_COEFFICIENTS.get(data.get('region', 'Другой'), 1.0)
-        total = sum([foundation, roof, walls, insulation, windows, doors]) * region_coeff
-        details.append(f"{EMOJI_MAP['region']} Региональный коэффициент: ×{region_coeff:.1f}")
+        total = sum(sections.values())
+        details.append(f"{EMOJI_MAP['region']} Цены региона: {region}")
         
         if data.get('window_count', 0) > 5:
             total *= 0.95
@@ -599,6 +870,144 @@ class CostCalculator:
         
         return round(total), details
 
+class LeadQueue:
+    def __init__(self, chats, rate_limit, rate_period, max_message_length, regions):
+        self.check_config(chats, rate_limit, rate_period, regions)
+        self.chats = chats
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.max_message_length = max_message_length
+        self.queue = queue.Queue()
+        self.cursors = {}
+        self.sent = {}
+        self.digests = {}
+        # Заявки, упёршиеся в лимиты специалистов: region -> deque; разбирает только рабочий поток
+        self.pending = {}
+        self.ready_at = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def check_config(chats, rate_limit, rate_period, regions):
+        # Ошибки конфигурации ловим при загрузке, а не после ответа пользователю «Запрос принят»
+        if rate_limit < 1:
+            raise ValueError("LEAD_RATE_LIMIT должен быть не меньше 1")
+        if rate_period <= 0:
+            raise ValueError("LEAD_RATE_PERIOD должен быть больше 0")
+        if not isinstance(chats, dict):
+            raise ValueError('SPECIALIST_CHATS: ожидается объект {"регион": [chat_id, ...]}')
+        for region, pool in chats.items():
+            if not isinstance(pool, list):
+                raise ValueError(f"SPECIALIST_CHATS[{region!r}]: ожидается список chat_id")
+        uncovered = [region for region in regions if not chats.get(region)]
+        if uncovered and not chats.get('*'):
+            raise ValueError(
+                f"SPECIALIST_CHATS: нет специалистов для регионов {', '.join(uncovered)} и нет общего пула '*'"
+            )
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, region, text, low_priority=False):
+        if low_priority:
+            with self.lock:
+                self.digests.setdefault(region, []).append(text)
+        else:
+            self.queue.put_nowait((region, text))
+
+    def flush_digests(self):
+        with self.lock:
+            digests, self.digests = self.digests, {}
+        for region, leads in digests.items():
+            for chunk in self._split(leads):
+                self.queue.put_nowait((region, f"Дайджест заявок ({len(chunk)}):\n\n" + "\n\n".join(chunk)))
+
+    def _split(self, leads):
+        chunk, size = [], 0
+        for lead in leads:
+            if chunk and size + len(lead) > self.max_message_length:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(lead)
+            size += len(lead) + 2
+        if chunk:
+            yield chunk
+
+    def _acquire(self, region):
+        # Round-robin по пулу региона; возвращает (chat_id, None) или (None, секунды ожидания)
+        pool = self.chats.get(region) or self.chats.get('*', [])
+        if not pool:
+            return None, None
+        now = time.monotonic()
+        start = self.cursors.get(region, 0)
+        wait = None
+        for offset in range(len(pool)):
+            index = (start + offset) % len(pool)
+            sent = self.sent.setdefault(pool[index], deque())
+            while sent and now - sent[0] >= self.rate_period:
+                sent.popleft()
+            if len(sent) < self.rate_limit:
+                sent.append(now)
+                self.cursors[region] = (index + 1) % len(pool)
+                return pool[index], None
+            remaining = self.rate_period - (now - sent[0])
+            wait = remaining if wait is None else min(wait, remaining)
+        return None, wait
+
+    def _hold(self, region, text):
+        self.pending.setdefault(region, deque()).append(text)
+
+    def _timeout(self):
+        # Сколько ждать новую заявку, пока не освободится лимит у ожидающего региона
+        waiting = [self.ready_at.get(region, 0) for region, leads in self.pending.items() if leads]
+        if not waiting:
+            return None
+        return max(0, min(waiting) - time.monotonic())
+
+    def _ready(self):
+        # Заявки, которые можно отправить сейчас, в порядке поступления внутри региона
+        now = time.monotonic()
+        ready = []
+        for region, leads in self.pending.items():
+            if self.ready_at.get(region, 0) > now:
+                continue
+            while leads:
+                chat_id, wait = self._acquire(region)
+                if chat_id is None:
+                    if wait is None:
+                        logger.error(f"Нет специалистов для региона {region}, заявок потеряно: {len(leads)}")
+                        leads.clear()
+                    else:
+                        self.ready_at[region] = now + wait
+                    break
+                ready.append((chat_id, leads.popleft()))
+        return ready
+
+    def _run(self):
+        while True:
+            try:
+                try:
+                    self._hold(*self.queue.get(timeout=self._timeout()))
+                    self.queue.task_done()
+                except queue.Empty:
+                    pass
+                for chat_id, text in self._ready():
+                    try:
+                        bot.send_message(chat_id, text)
+                    except Exception as e:
+                        logger.error(f"Ошибка доставки заявки: {str(e)}")
+            except Exception as e:
+                # Рабочий поток не должен умирать молча — иначе все следующие заявки теряются
+                logger.exception(f"Ошибка очереди заявок: {str(e)}")
+                time.sleep(1)
+
+lead_queue = LeadQueue(
+    SPECIALIST_CHATS,
+    LEAD_CONFIG['rate_limit'],
+    LEAD_CONFIG['rate_period'],
+    LEAD_CONFIG['max_message_length'],
+    REGIONS
+)
+
 def calculate_and_send_result(user_id):
     try:
         user = get_user_data(user_id)
@@ -612,7 +1021,7 @@ def calculate_and_send_result(user_id):
         bot.send_message(user_id, f"{STYLES['error']} Ошибка расчета: {str(e)}")
         track_event('abandon', project['data'].get('step', 0))
 
-def send_result_message(user_id, total, details):
+def format_result(total, details):
     formatted_details = []
     for item in details:
         parts = item.split(':')
@@ -632,59 +1041,82 @@ def send_result_message(user_id, total, details):
     
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     markup.row("📨 Отправить специалисту", "🖨️ Экспорт в PDF")
-    markup.row("🔙 Главное меню")
-    
+    markup.row("📋 Ведомость материалов", "🔙 Главное меню")
+    return "\n".join(result), markup
+
+def send_result_message(user_id, total, details):
+    text, markup = format_result(total, details)
     bot.send_message(
         user_id,
-        "\n".join(result),
+        text,
         reply_markup=markup,
         parse_mode='HTML'
     )
 
+def latest_completed_project(user):
+    completed_projects = [
+        p for p in user['projects'].values() 
+        if p.get('completed', False)
+    ]
+    if not completed_projects:
+        return None
+    return max(
+        completed_projects,
+        key=lambda p: p['created_at']
+    )
+
+def render_pdf(project, total, details):
+    buffer = BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    pdf.setFont("Courier", 12)
+    text = pdf.beginText(40, 750)
+    
+    text.textLine(f"Смета для проекта: {project['name']}")
+    text.textLine(f"Дата: {datetime.now().strftime('%d.%m.%Y')}")
+    text.textLine("")
+    
+    for line in details:
+        clean_line = line.replace('<b>', '').replace('</b>', '').replace('<code>', '').replace('</code>', '')
+        text.textLine(clean_line)
+    
+    text.textLine("")
+    text.textLine(f"Итоговая стоимость: {total:,.0f} руб.")
+    pdf.drawText(text)
+    pdf.save()
+    
+    buffer.seek(0)
+    return buffer
+
+def format_lead(project, username, total, details):
+    formatted_details = "\n".join(details).replace(STYLES['currency'], 'руб.')
+    return "\n".join([
+        f"Новый запрос от @{username}",
+        f"Проект: {project['name']}",
+        f"Регион: {project['data'].get('region', 'Не указан')}",
+        f"Площадь: {project['data']['width']}x{project['data']['length']} м",
+        f"Стиль: {project['data'].get('house_style', 'Не указан')}",
+        "Детали:",
+        formatted_details,
+        f"Итоговая стоимость: {total:,.0f} руб."
+    ])
+
 # ИСПРАВЛЕНИЯ ДЛЯ PDF
 @bot.message_handler(func=lambda m: m.text == "🖨️ Экспорт в PDF")
+@load_guard('pdf_export')
 def export_to_pdf(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
     
     # Ищем последний завершенный проект
-    completed_projects = [
-        p for p in user['projects'].values() 
-        if p.get('completed', False)
-    ]
-    
-    if not completed_projects:
+    project = latest_completed_project(user)
+    if not project:
         bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
         return
     
-    project = max(
-        completed_projects,
-        key=lambda p: p['created_at']
-    )
-    
     try:
         total, details = CostCalculator.calculate_total(project['data'])
         
-        # Генерация PDF
-        buffer = BytesIO()
-        pdf = canvas.Canvas(buffer, pagesize=letter)
-        pdf.setFont("Courier", 12)
-        text = pdf.beginText(40, 750)
-        
-        text.textLine(f"Смета для проекта: {project['name']}")
-        text.textLine(f"Дата: {datetime.now().strftime('%d.%m.%Y')}")
-        text.textLine("")
-        
-        for line in details:
-            clean_line = line.replace('<b>', '').replace('</b>', '').replace('<code>', '').replace('</code>', '')
-            text.textLine(clean_line)
-        
-        text.textLine("")
-        text.textLine(f"Итоговая стоимость: {total:,.0f} руб.")
-        pdf.drawText(text)
-        pdf.save()
-        
-        buffer.seek(0)
+        buffer = render_pdf(project, total, details)
         bot.send_document(
             user_id,
             ('smeta.pdf', buffer),
@@ -696,42 +1128,49 @@ def export_to_pdf(message):
         logger.error(f"Ошибка генерации PDF: {str(e)}")
         bot.send_message(user_id, f"{STYLES['error']} Ошибка генерации PDF: {str(e)}")
 
+@bot.message_handler(func=lambda m: m.text == "📋 Ведомость материалов")
+@load_guard()
+def export_bom(message):
+    user_id = message.chat.id
+    user = get_user_data(user_id)
+    
+    project = latest_completed_project(user)
+    if not project:
+        bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
+        return
+    
+    try:
+        bom = BillOfMaterials.calculate(project['data'])
+        bot.send_document(
+            user_id,
+            ('vedomost.csv', BytesIO(BillOfMaterials.to_csv(bom))),
+            caption=f"📋 Ведомость материалов проекта {project['name']}",
+            reply_markup=create_main_menu()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки ведомости: {str(e)}")
+        bot.send_message(user_id, f"{STYLES['error']} Ошибка выгрузки ведомости: {str(e)}")
+
 @bot.message_handler(func=lambda m: m.text == "📨 Отправить специалисту")
+@load_guard('specialist_send')
 def send_to_specialist(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
     
-    completed_projects = [
-        p for p in user['projects'].values() 
-        if p.get('completed', False)
-    ]
-    
-    if not completed_projects:
+    project = latest_completed_project(user)
+    if not project:
         bot.send_message(user_id, f"{STYLES['error']} Нет завершенных проектов")
         return
     
-    project = max(
-        completed_projects,
-        key=lambda p: p['created_at']
-    )
-    
     try:
         total, details = CostCalculator.calculate_total(project['data'])
-        formatted_details = "\n".join(details).replace(STYLES['currency'], 'руб.')
-        
-        result = [
-            f"Новый запрос от @{message.from_user.username}",
-            f"Проект: {project['name']}",
-            f"Регион: {project['data'].get('region', 'Не указан')}",
-            f"Площадь: {project['data']['width']}x{project['data']['length']} м",
-            f"Стиль: {project['data'].get('house_style', 'Не указан')}",
-            "Детали:",
-            formatted_details,
-            f"Итоговая стоимость: {total:,.0f} руб."
-        ]
-        
-        bot.send_message(515650034, "\n".join(result))
-        bot.send_message(user_id, f"{STYLES['success']} Запрос отправлен специалисту!")
+        lead = format_lead(project, message.from_user.username, total, details)
+        lead_queue.submit(
+            project['data'].get('region', 'Другой'),
+            lead,
+            low_priority=total < LEAD_CONFIG['low_priority_total']
+        )
+        bot.send_message(user_id, f"{STYLES['success']} Запрос принят, специалист свяжется с вами!")
     
     except Exception as e:
         logger.error(f"Ошибка отправки: {str(e)}")
@@ -740,6 +1179,7 @@ def send_to_specialist(message):
     show_main_menu(message)
 
 @bot.message_handler(func=lambda m: m.text == "📚 Гайды")
+@load_guard()
 def show_guides_menu(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
@@ -757,6 +1197,7 @@ def show_guides_menu(message):
     )
 
 @bot.message_handler(func=lambda m: m.text in [g['title'] for g in GUIDES.values()])
+@load_guard()
 def show_guide_content(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
@@ -777,10 +1218,12 @@ def show_guide_content(message):
             break
 
 @bot.message_handler(func=lambda m: m.text == "🔙 К списку гайдов")
+@load_guard()
 def back_to_guides(message):
     show_guides_menu(message)
 
 @bot.message_handler(func=lambda m: m.text == "🔙 Главное меню")
+@load_guard()
 def back_to_main_menu(message):
     user_id = message.chat.id
     user = get_user_data(user_id)
@@ -789,10 +1232,144 @@ def back_to_main_menu(message):
 
 @app.route(f'/{API_TOKEN}', methods=['POST'])
 def webhook():
+    if load_monitor.backlog() >= load_monitor.reject_backlog:
+        # Telegram повторит доставку позже — это и есть обратное давление
+        load_monitor.record_shed('update')
+        return '', 503
     update = telebot.types.Update.de_json(request.stream.read().decode('utf-8'))
+    if update.message:
+        update.message.received_at = time.monotonic()
+        allowed, notify = flood_guard.check(update.message)
+        if notify:
+            # Через пул потоков telebot, чтобы не занимать поток веб-сервера
+            bot._exec_task(bot.send_message, update.message.chat.id, FLOOD_NOTICE)
+        if not allowed:
+            return '', 200
     bot.process_new_updates([update])
     return '', 200
 
+EXPORT_CONFIG = {
+    'page_size': int(os.getenv('EXPORT_PAGE_SIZE', 500)),
+    'chunk_size': 16 * 1024,
+    'mimetypes': {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+}
+
+EXPORT_FIELDS = {
+    'projects': ['user_id', 'project_id', 'name', 'created_at', 'completed', 'step',
+                 'region', 'house_style', 'width', 'length', 'total'],
+    'funnel': ['step', 'key', 'reached', 'stopped', 'input_errors']
+}
+
+def admin_authorized(token):
+    # Сравниваем байты: compare_digest на str падает с TypeError на не-ASCII
+    return bool(ADMIN_TOKEN) and hmac.compare_digest((token or '').encode(), ADMIN_TOKEN.encode())
+
+def iter_projects():
+    # Пользователи из user_data не удаляются, поэтому обход по смещению стабилен.
+    # Страница снимается одним коротким срезом, обработчики не ждут всю выгрузку.
+    offset = 0
+    while True:
+        try:
+            page = list(islice(user_data.items(), offset, offset + EXPORT_CONFIG['page_size']))
+        except RuntimeError:
+            continue  # словарь изменился во время среза — повторяем страницу
+        if not page:
+            return
+        offset += len(page)
+        for user_id, user in page:
+            for project_id, project in list(user['projects'].items()):
+                yield user_id, project_id, project
+
+def project_rows():
+    for user_id, project_id, project in iter_projects():
+        data = project['data']
+        total = None
+        if project.get('completed'):
+            try:
+                total, _ = CostCalculator.calculate_total(data, cached=False)
+            except Exception as e:
+                logger.error(f"Ошибка расчета при выгрузке {project_id}: {str(e)}")
+        yield {
+            'user_id': user_id,
+            'project_id': project_id,
+            'name': project['name'],
+            'created_at': project['created_at'].isoformat(),
+            'completed': project.get('completed', False),
+            'step': data.get('step', 0),
+            'region': data.get('region'),
+            'house_style': data.get('house_style'),
+            'width': data.get('width'),
+            'length': data.get('length'),
+            'total': total
+        }
+
+def funnel_rows():
+    reached = [0] * TOTAL_STEPS
+    stopped = [0] * TOTAL_STEPS
+    for _, _, project in iter_projects():
+        data = project['data']
+        step = TOTAL_STEPS if project.get('completed') else data.get('step', 0)
+        if step < TOTAL_STEPS:
+            # Текущий шаг уже прошел проверку условия в advance_questionnaire
+            stopped[step] += 1
+            reached[step] += 1
+        # Пройденные шаги считаем, только если вопрос показывался (условие выполнено)
+        for s in range(min(step, TOTAL_STEPS)):
+            condition = QUESTIONS[s].get('condition')
+            if condition is None or condition(data):
+                reached[s] += 1
+    for s, question in enumerate(QUESTIONS):
+        yield {
+            'step': s + 1,
+            'key': question['key'],
+            'reached': reached[s],
+            'stopped': stopped[s],
+            'input_errors': analytics_data['abandoned_steps'].get(s, 0)
+        }
+
+def stream_rows(rows, fields, fmt):
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, delimiter=';')
+    if fmt == 'csv':
+        writer.writeheader()
+    for row in rows:
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + '\n')
+        if buffer.tell() >= EXPORT_CONFIG['chunk_size']:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_stream(dataset, fmt):
+    # Возвращает (генератор фрагментов, mimetype, имя файла) или None при неверных параметрах
+    if dataset not in EXPORT_FIELDS or fmt not in EXPORT_CONFIG['mimetypes']:
+        return None
+    rows = project_rows() if dataset == 'projects' else funnel_rows()
+    return stream_rows(rows, EXPORT_FIELDS[dataset], fmt), EXPORT_CONFIG['mimetypes'][fmt], f"{dataset}.{fmt}"
+
+@app.route('/admin/export')
+def admin_export():
+    if not admin_authorized(request.headers.get('X-Admin-Token')):
+        return '', 403
+    export = export_stream(request.args.get('dataset', 'projects'), request.args.get('format', 'csv'))
+    if export is None:
+        return '', 400
+    chunks, mimetype, filename = export
+    return Response(
+        chunks,
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@app.route('/load')
+def load_stats():
+    if not admin_authorized(request.headers.get('X-Admin-Token')):
+        return '', 403
+    return jsonify(dict(load_monitor.stats(), flood_dropped=flood_guard.dropped))
+
 def self_ping():
     import threading
     while True:
@@ -803,7 +1380,25 @@ def self_ping():
             logger.error(f"Ошибка self-ping: {str(e)}")
         threading.Event().wait(300)
 
+def start_background():
+    bot.threaded = True
+    bot.worker_pool = telebot.util.ThreadPool(bot)
+    scheduler.start()
+    lead_queue.start()
+    scheduler.add_job(
+        lead_queue.flush_digests,
+        'interval',
+        minutes=LEAD_CONFIG['digest_interval'],
+        id='lead_digest'
+    )
+
+def create_app():
+    start_background()
+    return app
+
 if __name__ == '__main__':
+    start_background()
+    
     import threading
     ping_thread = threading.Thread(target=self_ping, daemon=True)
     ping_thread.start()